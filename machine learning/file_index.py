@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Index the image files under one or more dataset roots. Used by
+write_groups_csv.py to find the files to split and by
+generalized_classifier.py to count samples (keras' flow_from_directory still
+walks the data dirs itself when loading).
+
+Directories are scanned in parallel with os.scandir, one level of the tree
+at a time. The result can be cached in a json manifest that records, per
+directory, its mtime, subdirs and the size/mtime of each file. On the next
+run a directory whose mtime has not changed is taken from the manifest
+instead of being rescanned, so only directories where files were added,
+removed or renamed are read again.
+
+Note: editing a file in place does not change its directory's mtime, so the
+size/mtime recorded for that file can go stale. Delete the manifest to force
+a full rescan.
+
+Usage:
+    ./file_index.py data/ -m data/manifest.json
+"""
+
+import os
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+# Same set of extensions that keras' flow_from_directory will load
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.bmp', '.ppm', '.tif', '.tiff')
+
+def parse_args():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('roots', nargs='+', help='Dataset dirs to index')
+    ap.add_argument('-m', '--manifest', type=str, 
+                    help='json manifest to read/update')
+    ap.add_argument('-j', '--jobs', type=int, default=8,
+                    help='Number of dirs to scan in parallel (def: 8)')
+    args = ap.parse_args()
+    return args
+
+def load_manifest(manifest):
+    """ Ret dict of dirpath : entry, empty if there is no manifest yet """
+    if not manifest or not os.path.exists(manifest):
+        return {}
+    with open(manifest) as f:
+        return json.load(f)['dirs']
+
+def save_manifest(manifest, dirs):
+    tmp = manifest + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'dirs' : dirs}, f)
+    os.replace(tmp, manifest)
+
+def scan_dir(path, cached=None):
+    """
+    Ret entry : dict with the dir's mtime, list of subdir names and list of
+        [name, size, mtime] for each file. `cached` is returned as is if the
+        dir has not changed since it was recorded, and None if the dir no
+        longer exists or can't be read. Like os.walk, symlinked dirs are not
+        followed and unreadable dirs are skipped.
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+        if cached is not None and cached['mtime'] == mtime:
+            return cached
+        it = os.scandir(path)
+    except FileNotFoundError:
+        # deleted while we were scanning
+        return None
+    except PermissionError:
+        print('Skipping unreadable dir %s' % path)
+        return None
+
+    subdirs, files = [], []
+    with it:
+        for e in it:
+            if e.is_dir(follow_symlinks=False):
+                subdirs.append(e.name)
+            elif e.is_file():
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    # deleted since it was listed
+                    continue
+                files.append([e.name, st.st_size, st.st_mtime])
+    return {'mtime' : mtime, 'subdirs' : subdirs, 'files' : files}
+
+def scan_tree(roots, manifest=None, jobs=8):
+    """
+    Scan every dir below `roots`, reusing unchanged dirs from `manifest` and
+    writing the updated manifest back.
+
+    Ret dirs : dict of dirpath : entry (see scan_dir)
+    """
+    cache = load_manifest(manifest)
+    dirs = {}
+    frontier = [os.path.abspath(r) for r in roots]
+    with ThreadPoolExecutor(jobs) as ex:
+        while frontier:
+            entries = ex.map(lambda d: scan_dir(d, cache.get(d)), frontier)
+            level, frontier = frontier, []
+            for d, entry in zip(level, entries):
+                if entry is None:
+                    continue
+                dirs[d] = entry
+                frontier.extend(os.path.join(d, s) for s in entry['subdirs'])
+
+    if manifest:
+        # Keep entries for other roots that share this manifest, but drop
+        # dirs below these roots that no longer exist
+        roots = [os.path.abspath(r) for r in roots]
+        cache = dict((d, e) for d, e in cache.items() 
+                     if not any(d == r or d.startswith(r + os.sep) 
+                                for r in roots))
+        cache.update(dirs)
+        save_manifest(manifest, cache)
+    return dirs
+
+def index_files(roots, exts=IMAGE_EXTS, manifest=None, jobs=8):
+    """
+    Ret files : sorted list of (path, size, mtime) for each file below
+        `roots` whose extension is in `exts` (case insensitive). Pass
+        exts=None to keep every file.
+    """
+    dirs = scan_tree(roots, manifest, jobs)
+    files = []
+    for d, entry in dirs.items():
+        for name, size, mtime in entry['files']:
+            if exts is None or os.path.splitext(name)[1].lower() in exts:
+                files.append((os.path.join(d, name), size, mtime))
+    files.sort()
+    return files
+
+def count_files(folder, exts=IMAGE_EXTS, manifest=None, jobs=8):
+    return len(index_files([folder], exts, manifest, jobs))
+
+def main():
+    args = parse_args()
+    files = index_files(args.roots, manifest=args.manifest, jobs=args.jobs)
+    print('%d image files, %.1f MB' 
+          %(len(files), sum(f[1] for f in files) / 1e6))
+
+if __name__ == '__main__':
+    main()
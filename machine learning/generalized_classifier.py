@@ -40,18 +40,25 @@ data/
 '''
 
 from keras.preprocessing.image import ImageDataGenerator
+from keras.preprocessing.image import load_img, img_to_array
 from keras.models import Sequential, load_model
 from keras.layers import Conv2D, MaxPooling2D
 from keras.layers import Activation, Dropout, Flatten, Dense
+from keras.callbacks import Callback, ModelCheckpoint, EarlyStopping
+from keras.utils import Sequence
 from keras import backend as K
 import argparse
 import sys
 import os
+import csv
+import json
+import time
 import pickle
+import numpy as np
+import file_index
 
-def subdirs_file_count(folder):
-    cpt = sum([len(files) for r, d, files in os.walk(folder)])
-    return cpt
+def subdirs_file_count(folder, manifest=None):
+    return file_index.count_files(folder, manifest=manifest)
 def parse_args():
     ap = argparse.ArgumentParser()
     ap.add_argument('--weights', type=str, help='.h5 weights to load')
@@ -69,99 +76,344 @@ def parse_args():
                     help='Batch size <what does this mean?> (def: 8)')
     ap.add_argument('-d', '--data', type=str, default='data',
                     help='Path to load data from (def: ./data)')
+    ap.add_argument('--manifest', type=str,
+                    help='File manifest to cache data dir indexing in')
+    ap.add_argument('-r', '--resume', action='store_true',
+                    help='Resume from the latest checkpoint of the output \
+                    model (<model>-latest.h5, <model>-state.json)')
+    ap.add_argument('-c', '--checkpoint_every', type=int, default=1,
+                    help='Save the latest checkpoint every N epochs (def: 1)')
+    ap.add_argument('--monitor', type=str, default='val_loss',
+                    help='Metric used to pick the best checkpoint and for \
+                    early stopping (def: val_loss)')
+    ap.add_argument('-p', '--patience', type=int, default=0,
+                    help='Stop after N epochs without improvement of \
+                    --monitor. 0 to disable (def: 0)')
+    ap.add_argument('--seed', type=int, default=1,
+                    help='Seed for shuffling/augmentation. Each epoch\'s \
+                    data order is set by the seed and epoch number, so a \
+                    resumed run sees the same data (def: 1)')
+    ap.add_argument('-s', '--size', type=int, default=299,
+                    help='Images are resized to size x size px (def: 299)')
+    ap.add_argument('--width', type=int, default=32,
+                    help='Number of filters in the first conv layer, sets \
+                    the width of the whole model (def: 32)')
+    ap.add_argument('--sweep', type=int, nargs='+',
+                    help='Train and evaluate one model per image size \
+                    given, reporting speed and accuracy of each, e.g. \
+                    --sweep 64 128 299')
+    ap.add_argument('--sweep_csv', type=str, default='sweep.csv',
+                    help='Where to write sweep results (def: sweep.csv)')
+    ap.add_argument('--positive', type=str,
+                    help='Name of the positive (CTC) class dir, used for \
+                    sensitivity. Def: the second class in sorted order')
     
     args = ap.parse_args()
+
+    # A model/weights file only fits the input size it was trained with
+    if args.sweep and (args.load or args.weights):
+        ap.error('--load/--weights cannot be used with --sweep')
+    # Catch a typo or too small a size now rather than after hours of
+    # training
+    for size in (args.sweep if args.sweep else [args.size]):
+        if not model_fits(size):
+            ap.error('size %d px is too small for the model, must be at '
+                     'least %d' % (size, MIN_SIZE))
+    if args.sweep and args.positive:
+        classes = class_dirs(os.path.join(args.data, 'validation'))
+        if args.positive not in classes:
+            ap.error('--positive %s is not one of the classes: %s' 
+                     % (args.positive, ', '.join(classes)))
     
     # Report
     print('Run %d epochs with a batch size of %d' % (args.epochs, args.batch))
     print('Output model name: %s' % args.output_model)
 
     return args
+# smallest input that initialize_model's conv/pool stack can take
+MIN_SIZE = 22
+def model_fits(size):
+    """ Check that each conv (3x3, valid) and 2x2 pool leaves >= 1 px """
+    for _ in range(3):
+        size = (size - 2) // 2
+    return size >= 1
+def class_dirs(folder):
+    """ Ret sorted class dir names, as keras' flow_from_directory finds them """
+    return sorted(d for d in os.listdir(folder) 
+                  if os.path.isdir(os.path.join(folder, d)))
+def checkpoint_paths(output_model):
+    """ Ret paths of the best/latest checkpoints and training state """
+    base = os.path.splitext(output_model)[0]
+    return {'best' : base + '-best.h5', 
+            'best_state' : base + '-best.json',
+            'latest' : base + '-latest.h5',
+            'state' : base + '-state.json'}
+def load_state(path):
+    with open(path) as f:
+        return json.load(f)
+def save_state(path, state):
+    # write to a tmp file first so a crash can't leave a partial state
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+def random_transform(datagen, shape, rng):
+    """
+    Draw augmentation params for one image of `shape` from `rng`, the way
+    ImageDataGenerator.get_random_transform does from the global np.random.
+    Covers the float ranges and flips used in train().
+    """
+    img_row_axis = datagen.row_axis - 1
+    img_col_axis = datagen.col_axis - 1
+    def uniform(r):
+        return rng.uniform(-r, r) if r else 0
+    tx = uniform(datagen.height_shift_range)
+    if datagen.height_shift_range < 1:
+        tx *= shape[img_row_axis]
+    ty = uniform(datagen.width_shift_range)
+    if datagen.width_shift_range < 1:
+        ty *= shape[img_col_axis]
+    if datagen.zoom_range[0] == 1 and datagen.zoom_range[1] == 1:
+        zx, zy = 1, 1
+    else:
+        zx, zy = rng.uniform(datagen.zoom_range[0], datagen.zoom_range[1], 2)
+    return {'theta' : uniform(datagen.rotation_range),
+            'tx' : tx,
+            'ty' : ty,
+            'shear' : uniform(datagen.shear_range),
+            'zx' : zx,
+            'zy' : zy,
+            'flip_horizontal' : (rng.random_sample() < 0.5) 
+                                * datagen.horizontal_flip,
+            'flip_vertical' : (rng.random_sample() < 0.5) 
+                              * datagen.vertical_flip}
+class EpochSeededFlow(Sequence):
+    """
+    Serve `steps` batches per epoch from the files of a keras
+    DirectoryIterator, with the shuffle and augmentation of every batch set
+    by (seed, epoch, batch) alone, so a resumed run sees the same data as an
+    uninterrupted one. Augmentation is drawn from a local RandomState, not
+    the global np.random that the validation generator also uses.
+
+    The enqueuer calls on_epoch_end once it has fetched all `steps` batches
+    of an epoch, so the epoch count here stays right despite prefetching.
+    Fit with shuffle=False, or the enqueuer reorders batches at random.
+    """
+    def __init__(self, iterator, steps, seed, epoch=0):
+        self.iterator = iterator
+        self.steps = steps
+        self.seed = seed
+        self.set_epoch(epoch)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        rng = np.random.RandomState([self.seed, epoch])
+        self.index_array = rng.permutation(self.iterator.n)
+
+    def __len__(self):
+        return self.steps
+
+    def __getitem__(self, idx):
+        it = self.iterator
+        datagen = it.image_data_generator
+        rng = np.random.RandomState([self.seed, self.epoch, idx])
+        index_array = self.index_array[idx * it.batch_size:
+                                       (idx + 1) * it.batch_size]
+        batch_x = np.zeros((len(index_array),) + it.image_shape, 
+                           dtype=K.floatx())
+        for i, j in enumerate(index_array):
+            img = load_img(os.path.join(it.directory, it.filenames[j]),
+                           target_size=it.target_size)
+            x = img_to_array(img, data_format=it.data_format)
+            x = datagen.apply_transform(x, random_transform(datagen, 
+                                                            x.shape, rng))
+            batch_x[i] = datagen.standardize(x)
+        return batch_x, it.classes[index_array].astype(K.floatx())
+
+    def on_epoch_end(self):
+        self.set_epoch(self.epoch + 1)
+class BestCheckpoint(ModelCheckpoint):
+    """ 
+    ModelCheckpoint(save_best_only=True) that records the best value next to
+    the checkpoint each time it is written, so a resume starts from the value
+    of the model actually on disk.
+    """
+    def __init__(self, filepath, state_path, **kwargs):
+        super(BestCheckpoint, self).__init__(filepath, save_best_only=True,
+                                             **kwargs)
+        self.state_path = state_path
+        if os.path.exists(state_path):
+            self.best = load_state(state_path)['best']
+
+    def on_epoch_end(self, epoch, logs=None):
+        best = self.best
+        super(BestCheckpoint, self).on_epoch_end(epoch, logs)
+        if self.best != best:
+            save_state(self.state_path, {'best' : float(self.best),
+                                         'epoch' : epoch + 1})
+class ResumableEarlyStopping(EarlyStopping):
+    """ EarlyStopping that can pick up its patience count from a checkpoint """
+    def __init__(self, state=None, **kwargs):
+        super(ResumableEarlyStopping, self).__init__(**kwargs)
+        self.state = state
+
+    def on_train_begin(self, logs=None):
+        super(ResumableEarlyStopping, self).on_train_begin(logs)
+        if self.state:
+            self.wait = self.state['wait']
+            self.best = self.state['best']
+class TrainingState(Callback):
+    """ 
+    Every `every` epochs save the model (incl. optimizer state) to
+    `paths['latest']`, and the epoch counter, early stopping state and
+    history so far to `paths['state']`.
+    """
+    def __init__(self, paths, early_stopping=None, history=None, every=1):
+        super(TrainingState, self).__init__()
+        self.paths = paths
+        self.early_stopping = early_stopping
+        self.history = history if history else {}
+        self.every = every
+
+    def on_epoch_end(self, epoch, logs=None):
+        for k, v in (logs or {}).items():
+            self.history.setdefault(k, []).append(float(v))
+        if (epoch + 1) % self.every:
+            return
+
+        state = {'epoch' : epoch + 1,
+                 'history' : self.history}
+        if self.early_stopping:
+            state['early_stopping'] = {
+                'wait' : self.early_stopping.wait,
+                'best' : float(self.early_stopping.best)}
+
+        self.model.save(self.paths['latest'])
+        save_state(self.paths['state'], state)
+class TrainingSpeed(Callback):
+    """ Time spent in training batches only, excluding data loading """
+    def on_train_begin(self, logs=None):
+        self.seconds = 0.
+        self.images = 0
+        self.epochs = 0
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epochs += 1
+
+    def on_batch_begin(self, batch, logs=None):
+        self.t = time.time()
+
+    def on_batch_end(self, batch, logs=None):
+        self.seconds += time.time() - self.t
+        self.images += (logs or {}).get('size', 0)
+
+    def imgs_per_s(self):
+        return self.images / self.seconds if self.seconds else float('nan')
 def evaluations(model):
     from sklearn.metrics import confusion_matrix
 
     def plot_images(images, cls_true, cls_pred=None):
-    assert len(images) == len(cls_true) == 9
-    
-    # Create figure with 3x3 sub-plots.
-    fig, axes = plt.subplots(3, 3)
-    fig.subplots_adjust(hspace=0.3, wspace=0.3)
-
-    for i, ax in enumerate(axes.flat):
-        # Plot image.
-        ax.imshow(images[i].reshape(img_shape), cmap='binary')
-
-        # Show true and predicted classes.
-        if cls_pred is None:
-            xlabel = "True: {0}".format(cls_true[i])
-        else:
-            xlabel = "True: {0}, Pred: {1}".format(cls_true[i], cls_pred[i])
-
-        # Show the classes as the label on the x-axis.
-        ax.set_xlabel(xlabel)
+        assert len(images) == len(cls_true) == 9
         
-        # Remove ticks from the plot.
-        ax.set_xticks([])
-        ax.set_yticks([])
-    
-    # Ensure the plot is shown correctly with multiple plots
-    # in a single Notebook cell.
-    plt.show()
+        # Create figure with 3x3 sub-plots.
+        fig, axes = plt.subplots(3, 3)
+        fig.subplots_adjust(hspace=0.3, wspace=0.3)
 
-def main():
-    args = parse_args()
+        for i, ax in enumerate(axes.flat):
+            # Plot image.
+            ax.imshow(images[i].reshape(img_shape), cmap='binary')
+
+            # Show true and predicted classes.
+            if cls_pred is None:
+                xlabel = "True: {0}".format(cls_true[i])
+            else:
+                xlabel = "True: {0}, Pred: {1}".format(cls_true[i], cls_pred[i])
+
+            # Show the classes as the label on the x-axis.
+            ax.set_xlabel(xlabel)
+            
+            # Remove ticks from the plot.
+            ax.set_xticks([])
+            ax.set_yticks([])
+        
+        # Ensure the plot is shown correctly with multiple plots
+        # in a single Notebook cell.
+        plt.show()
+
+def initialize_model(input_shape, width=32, weights=None):
+    """
+    Three conv/pool blocks then a dense layer. `width` is the number of
+    filters in the first two conv layers, the third conv and the dense layer
+    get twice as many.
+    """
+    model = Sequential()
+    model.add(Conv2D(width, (3, 3), input_shape=input_shape))
+    model.add(Activation('relu'))
+    model.add(MaxPooling2D(pool_size=(2, 2)))
+
+    model.add(Conv2D(width, (3, 3)))
+    model.add(Activation('relu'))
+    model.add(MaxPooling2D(pool_size=(2, 2)))
+
+    model.add(Conv2D(2 * width, (3, 3)))
+    model.add(Activation('relu'))
+    model.add(MaxPooling2D(pool_size=(2, 2)))
 
+    model.add(Flatten())
+    model.add(Dense(2 * width))
+    model.add(Activation('relu')) 
+    model.add(Dropout(0.5)) # learning rate?
+    model.add(Dense(1))
+    model.add(Activation('sigmoid'))
+
+    model.compile(loss='binary_crossentropy',
+                optimizer='rmsprop',
+                metrics=['accuracy'])
+
+    # load previous weights, if applicable
+    if weights:
+        model.load_weights(weights)
+
+    return model
+def get_input_shape(img_width, img_height):
+    if K.image_data_format() == 'channels_first':
+        return (3, img_width, img_height)
+    else:
+        return (img_width, img_height, 3)
+def train(args, img_size, output_model):
+    """
+    Train (or resume) one model on square `img_size` inputs, saving it and
+    its checkpoints/history under the name `output_model`.
+
+    Ret model, training_speed : the trained model and its TrainingSpeed
+        callback
+    """
     # dimensions of our images.
-    img_width, img_height = 299, 299
+    img_width, img_height = img_size, img_size
 
     train_data_dir = os.path.join(args.data, 'train')
     validation_data_dir = os.path.join(args.data, 'validation')
-    nb_train_samples = subdirs_file_count(train_data_dir)
+    nb_train_samples = subdirs_file_count(train_data_dir, args.manifest)
     print('nb train samples: %d' %nb_train_samples)
-    nb_validation_samples = subdirs_file_count(validation_data_dir)
+    nb_validation_samples = subdirs_file_count(validation_data_dir, 
+                                               args.manifest)
     print('nb validation samples: %d' %nb_validation_samples)
     epochs = args.epochs
-    batch_size = 8
+    batch_size = args.batch
 
-    if K.image_data_format() == 'channels_first':
-        input_shape = (3, img_width, img_height)
-    else:
-        input_shape = (img_width, img_height, 3)
-
-    def initialize_model(input_shape):
-        model = Sequential()
-        model.add(Conv2D(32, (3, 3), input_shape=input_shape))
-        model.add(Activation('relu'))
-        model.add(MaxPooling2D(pool_size=(2, 2)))
-
-        model.add(Conv2D(32, (3, 3)))
-        model.add(Activation('relu'))
-        model.add(MaxPooling2D(pool_size=(2, 2)))
-
-        model.add(Conv2D(64, (3, 3)))
-        model.add(Activation('relu'))
-        model.add(MaxPooling2D(pool_size=(2, 2)))
-
-        model.add(Flatten())
-        model.add(Dense(64))
-        model.add(Activation('relu')) 
-        model.add(Dropout(0.5)) # learning rate?
-        model.add(Dense(1))
-        model.add(Activation('sigmoid'))
-
-        model.compile(loss='binary_crossentropy',
-                    optimizer='rmsprop',
-                    metrics=['accuracy'])
-
-        # load previous weights, if applicable
-        if args.weights:
-            model.load_weights(args.weights)
-
-        return model
-    if args.load:
+    input_shape = get_input_shape(img_width, img_height)
+
+    paths = checkpoint_paths(output_model)
+    state = {}
+    if args.resume:
+        # model file includes the optimizer state
+        model = load_model(paths['latest'])
+        state = load_state(paths['state'])
+        print('Resuming from epoch %d' % state['epoch'])
+    elif args.load:
         model = load_model(args.load)
     else:
-        model = initialize_model
+        model = initialize_model(input_shape, args.width, args.weights)
 
     # this is the augmentation configuration we will use for training
     train_datagen = ImageDataGenerator(
@@ -174,28 +426,50 @@ def main():
         vertical_flip=True,
         horizontal_flip=True)
 
-    # this is the augmentation configuration we will use for testing:
-    # only rescaling
-    test_datagen = ImageDataGenerator(rescale=1. / 255)
-
     train_generator = train_datagen.flow_from_directory(
         train_data_dir,
         target_size=(img_width, img_height),
         batch_size=batch_size,
-        class_mode='binary')
+        class_mode='binary',
+        shuffle=False)
 
-    validation_generator = test_datagen.flow_from_directory(
-        validation_data_dir,
-        target_size=(img_width, img_height),
-        batch_size=batch_size,
-        class_mode='binary')
+    # Shuffle/augmentation depend only on (seed, epoch), so a resumed run
+    # picks up with the same data it would have seen uninterrupted
+    # Step counts come from the files keras found, which can differ from the
+    # index count (e.g. stray files, stale manifest)
+    train_flow = EpochSeededFlow(train_generator, 
+                                 train_generator.samples // batch_size,
+                                 args.seed, state.get('epoch', 0))
+
+    validation_generator = validation_flow(args, img_size)
 
-    history = model.fit_generator(
-        train_generator,
-        steps_per_epoch=nb_train_samples // batch_size,
+    # Keep the best model seen so far and the latest, resumable, state
+    if not args.resume and os.path.exists(paths['best_state']):
+        # a fresh run must not compare against an older run's best
+        os.remove(paths['best_state'])
+    checkpoint = BestCheckpoint(paths['best'], paths['best_state'],
+                                monitor=args.monitor)
+    callbacks = [checkpoint]
+    early_stopping = None
+    if args.patience:
+        early_stopping = ResumableEarlyStopping(
+            state=state.get('early_stopping'), monitor=args.monitor,
+            patience=args.patience)
+        callbacks.append(early_stopping)
+    training_state = TrainingState(paths, early_stopping, 
+                                   state.get('history'), args.checkpoint_every)
+    training_speed = TrainingSpeed()
+    callbacks += [training_state, training_speed]
+
+    model.fit_generator(
+        train_flow,
+        steps_per_epoch=len(train_flow),
         epochs=epochs,
         validation_data=validation_generator,
-        validation_steps=nb_validation_samples // batch_size)
+        validation_steps=validation_generator.samples // batch_size,
+        callbacks=callbacks,
+        shuffle=False,
+        initial_epoch=state.get('epoch', 0))
 
     # Print basic evaluation metrics
     # loss, accuracy = model.evaluate(train_generator, validation_generator)
@@ -203,13 +477,97 @@ def main():
 
     # Save the model to allow training to pick up where we left off
     # model.save_weights(args.output_weights)
-    model.save(args.output_model)
+    model.save(output_model)
 
     # save a historydict object
     # load with `pickle.load(open('pickle_object', 'rb'))`
-    hname = os.path.splitext(args.output_model)[0] + '-train_history.pkl'
+    hname = os.path.splitext(output_model)[0] + '-train_history.pkl'
     with open(hname, 'wb') as file_pi:
-        pickle.dump(history.history, file_pi)
+        pickle.dump(training_state.history, file_pi)
+
+    return model, training_speed
+def validation_flow(args, img_size):
+    # this is the augmentation configuration we will use for testing:
+    # only rescaling. Not shuffled, so predictions line up with .classes
+    test_datagen = ImageDataGenerator(rescale=1. / 255)
+    return test_datagen.flow_from_directory(
+        os.path.join(args.data, 'validation'),
+        target_size=(img_size, img_size),
+        batch_size=args.batch,
+        class_mode='binary',
+        shuffle=False)
+def validation_scores(model, generator, positive=None):
+    """
+    Predict every validation image once, timing only the model.
+
+    positive : str, name of the class (dir) counted as positive for
+        sensitivity/specificity. Def: the class with index 1.
+
+    Ret scores : dict of accuracy, sensitivity, specificity and images/s
+    """
+    pos = generator.class_indices[positive] if positive else 1
+    generator.reset()
+    steps = int(np.ceil(generator.samples / generator.batch_size))
+    y_true, y_pred = [], []
+    seconds = 0.
+    for _ in range(steps):
+        x, y = next(generator)
+        t = time.time()
+        p = model.predict_on_batch(x)
+        seconds += time.time() - t
+        y_true.append(y)
+        y_pred.append(np.ravel(p) > 0.5)
+    y_true = np.concatenate(y_true) == pos
+    y_pred = np.concatenate(y_pred) == bool(pos)
+
+    def ratio(a, b):
+        return a / b if b else float('nan')
+    return {'val_acc' : ratio(np.sum(y_true == y_pred), len(y_true)),
+            'sensitivity' : ratio(np.sum(y_true & y_pred), np.sum(y_true)),
+            'specificity' : ratio(np.sum(~y_true & ~y_pred), 
+                                  np.sum(~y_true)),
+            'infer_imgs_per_s' : ratio(len(y_true), seconds)}
+def sweep(args):
+    """
+    Train and evaluate one model per size in args.sweep, writing one row of
+    speed/accuracy results per size to args.sweep_csv.
+    """
+    base, ext = os.path.splitext(args.output_model)
+    columns = ['size', 'width', 'epochs', 'train_imgs_per_s', 
+               'infer_imgs_per_s', 'val_acc', 'sensitivity', 'specificity']
+    with open(args.sweep_csv, 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        for size in args.sweep:
+            print('\n### Sweep: %dx%d px' % (size, size))
+            output_model = '%s-%dpx%s' % (base, size, ext)
+            model, speed = train(args, size, output_model)
+            # Score the model that would be deployed, not the last epoch
+            best = checkpoint_paths(output_model)['best']
+            if os.path.exists(best):
+                model = load_model(best)
+            row = validation_scores(model, validation_flow(args, size), 
+                                    args.positive)
+            row.update({'size' : size, 'width' : args.width, 
+                        'epochs' : speed.epochs,
+                        'train_imgs_per_s' : speed.imgs_per_s()})
+            # Start the next size from an empty graph, so its speed does not
+            # depend on the models trained before it
+            del model
+            K.clear_session()
+            writer.writerow(row)
+            f.flush()
+            print('%(size)dpx: train %(train_imgs_per_s).1f img/s, infer '
+                  '%(infer_imgs_per_s).1f img/s, val acc %(val_acc).3f, '
+                  'sensitivity %(sensitivity).3f' % row)
+    print('Sweep results written to %s' % args.sweep_csv)
+
+def main():
+    args = parse_args()
+    if args.sweep:
+        sweep(args)
+    else:
+        train(args, args.size, args.output_model)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Score a plate of raw single channel (r,g,b) tiffs with a trained classifier,
+without writing merged or cropped images to disk in between.
+
+For each image the channels are read, illumination corrected and stacked
+exactly as channel_merge.py does, then the composite is cut into tiles that
+are scored in batches by the model. The next image is read and merged in a
+background thread while the current one is being scored, so two composites
+(plus one batch of copied tiles) are held in memory at a time.
+
+Training crops are 8 bit RGB, made with ImageJ's "Stack to RGB", which
+scales each channel to its display range. By default (`--scale minmax`) each
+channel of a composite is likewise stretched from its min/max to 0-255
+before tiling. Use `--scale none` for channels that are already 8 bit and
+should be used as is.
+
+Output is a csv with one row per tile:
+    image, x, y, score, flagged
+where (x, y) is the top left corner of the tile in the composite and score is
+the predicted probability of the positive (CTC) class. The model's sigmoid
+output is the probability of the class with index 1, the second class dir in
+sorted order. If the CTC class is index 0, pass `--positive 0` (or its name
+with `-d` pointing at the training data) and the score is 1 - output. With
+`--crops DIR` the tiles scoring at or above `--threshold` are also written to
+DIR/<image>-x<x>-y<y>.tif.
+
+Filenames in the plate dir are interpreted the same way as by
+channel_merge.py (see merge/README.md for the naming conventions), but the
+files are not renamed.
+
+Usage:
+    ./score_plate.py path/to/plate -m model.model -o plate-scores.csv
+"""
+
+import os
+import sys
+import csv
+import argparse
+from glob import glob
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from keras.models import load_model
+from keras import backend as K
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'merge'))
+import channel_merge
+from generalized_classifier import class_dirs
+
+def parse_args():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('path', type=str,
+                    help='Plate dir containing the channel tiffs')
+    ap.add_argument('-m', '--model', type=str, required=True,
+                    help='Keras model to score tiles with')
+    ap.add_argument('-o', '--output', type=str, default='scores.csv',
+                    help='Score table to write (def: scores.csv)')
+    ap.add_argument('-s', '--sigma', type=float, default=50.,
+                    help='Sigma value for gaussian blur during illumination \
+                    correction, as in channel_merge.py (def: 50)')
+    ap.add_argument('-t', '--tile', type=int,
+                    help='Tile size in px. Tiles are resized to the model \
+                    input if they differ. Def: the model input size')
+    ap.add_argument('--stride', type=int,
+                    help='Step between tiles in px. Def: the tile size')
+    ap.add_argument('-b', '--batch', type=int, default=64,
+                    help='Number of tiles scored at once (def: 64)')
+    ap.add_argument('--positive', type=str, default='1',
+                    help='Positive (CTC) class, by index or by name of its \
+                    dir in <data>/train. Def: index 1, the second class in \
+                    sorted order')
+    ap.add_argument('-d', '--data', type=str, default='data',
+                    help='Training data the model was trained on, used to \
+                    look up --positive by name (def: ./data)')
+    ap.add_argument('--threshold', type=float, default=0.5,
+                    help='Score at or above which a tile is flagged \
+                    (def: 0.5)')
+    ap.add_argument('-c', '--crops', type=str,
+                    help='Dir to write flagged tiles to. Created if DNE')
+    ap.add_argument('--scale', type=str, default='minmax', 
+                    choices=['minmax', 'none'],
+                    help='How to convert composites to 8 bit: stretch each \
+                    channel from its min/max (as ImageJ Stack to RGB with an \
+                    auto display range), or none for 8 bit input \
+                    (def: minmax)')
+    args = ap.parse_args()
+
+    # Resolve --positive to a class index
+    if args.positive.isdigit():
+        args.positive = int(args.positive)
+    else:
+        classes = class_dirs(os.path.join(args.data, 'train'))
+        if args.positive not in classes:
+            ap.error('--positive %s is not one of the classes: %s' 
+                     % (args.positive, ', '.join(classes)))
+        args.positive = classes.index(args.positive)
+    if args.positive not in (0, 1):
+        ap.error('--positive must be class 0 or 1 for a binary model')
+    return args
+
+def plate_uids(path):
+    """
+    Ret uids : dict of uid : [r, g, b] channel paths for the tiffs in path, as
+        channel_merge.py groups them, but from cleaned up names computed in
+        memory rather than by renaming the files
+    """
+    raw = sorted(os.path.basename(f) 
+                 for f in glob(os.path.join(path, '*.tif')))
+    real = dict(zip(channel_merge.format_filenames(raw), raw))
+    filenames = sorted(f for f in real if '-bf' not in f)
+    channels = channel_merge.group_images(filenames)
+    imgs = channel_merge.tiffs_iterate_combos(channels)
+    uids = channel_merge.get_uids(imgs)
+    return dict((uid, [os.path.join(path, real[f]) for f in imls]) 
+                for uid, imls in uids.items())
+
+def to_uint8(rgb, scale='minmax'):
+    """ 
+    Convert a composite to 8 bit like the training crops, see module doc
+    """
+    if scale == 'none':
+        return np.clip(rgb, 0, 255).astype('uint8')
+    lo = rgb.min(axis=(0, 1)).astype('float32')
+    hi = rgb.max(axis=(0, 1)).astype('float32')
+    x = (rgb.astype('float32') - lo) * (255. / np.maximum(hi - lo, 1))
+    return x.astype('uint8')
+
+def merge_8bit(uid, imls, sigma, scale):
+    rgb = channel_merge.merge_channels(uid, imls, sigma)
+    return None if rgb is None else to_uint8(rgb, scale)
+
+def merged_images(uids, sigma, scale, prefetch=1):
+    """
+    Yield (uid, rgb) for each set of channel files in `uids`, merging and
+    converting to 8 bit up to `prefetch` images ahead in a background thread.
+    """
+    with ThreadPoolExecutor(1) as ex:
+        pending = deque()
+        for uid in sorted(uids):
+            pending.append((uid, ex.submit(merge_8bit, uid, uids[uid], 
+                                           sigma, scale)))
+            if len(pending) > prefetch:
+                uid, future = pending.popleft()
+                yield uid, future.result()
+        while pending:
+            uid, future = pending.popleft()
+            yield uid, future.result()
+
+def tile_corners(length, tile, stride):
+    """ Tile offsets along one axis, the last tile is flush with the edge """
+    if length < tile:
+        return []
+    corners = list(range(0, length - tile + 1, stride))
+    if corners[-1] != length - tile:
+        corners.append(length - tile)
+    return corners
+
+def tiles(im, tile, stride):
+    """ Yield (x, y, crop) for each tile of im """
+    for y in tile_corners(im.shape[0], tile, stride):
+        for x in tile_corners(im.shape[1], tile, stride):
+            yield x, y, im[y:y + tile, x:x + tile]
+
+def to_batch(crops, size):
+    """
+    Stack 8 bit crops into one model input batch, resized and rescaled by
+    1/255 the same way as during training (keras resizes with nearest
+    neighbour interpolation).
+    """
+    x = np.stack([c if c.shape[:2] == (size, size)
+                  else cv2.resize(c, (size, size), 
+                                  interpolation=cv2.INTER_NEAREST) 
+                  for c in crops])
+    x = x.astype('float32') / 255.
+    if K.image_data_format() == 'channels_first':
+        x = x.transpose(0, 3, 1, 2)
+    return x
+
+def score_batch(model, batch, size, writer, threshold, cropdir, positive=1):
+    """ 
+    Score one batch of (uid, x, y, crop) and write out the results. Scores
+    are the probability of class index `positive`.
+    """
+    scores = np.ravel(model.predict_on_batch(to_batch([b[3] for b in batch],
+                                                      size)))
+    if positive == 0:
+        scores = 1 - scores
+    nflagged = 0
+    for (uid, x, y, crop), score in zip(batch, scores):
+        flagged = score >= threshold
+        writer.writerow([uid, x, y, '%.5f' % score, int(flagged)])
+        if flagged:
+            nflagged += 1
+            if cropdir:
+                channel_merge.tiffwrite(
+                    os.path.join(cropdir, '%s-x%d-y%d.tif' % (uid, x, y)),
+                    crop)
+    return nflagged
+
+def main():
+    args = parse_args()
+    output = os.path.abspath(args.output)
+    cropdir = os.path.abspath(args.crops) if args.crops else None
+    if cropdir and not os.path.exists(cropdir):
+        os.makedirs(cropdir)
+
+    model = load_model(args.model)
+    if K.image_data_format() == 'channels_first':
+        size = model.input_shape[2]
+    else:
+        size = model.input_shape[1]
+    tile = args.tile if args.tile else size
+    stride = args.stride if args.stride else tile
+
+    uids = plate_uids(args.path)
+    print('Scoring %d images from %s as probability of class %d' 
+          % (len(uids), args.path, args.positive))
+
+    ntiles, nflagged = 0, 0
+    with open(output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['image', 'x', 'y', 'score', 'flagged'])
+        batch = []
+        for uid, rgb in merged_images(uids, args.sigma, args.scale):
+            if rgb is None:
+                continue
+            if rgb.shape[0] < tile or rgb.shape[1] < tile:
+                print('Skipping image # %s. Smaller than one tile: %s' 
+                      % (uid, str(rgb.shape[:2])))
+                continue
+            for x, y, crop in tiles(rgb, tile, stride):
+                # copy, so the composite is freed once it has been tiled
+                batch.append((uid, x, y, crop.copy()))
+                if len(batch) == args.batch:
+                    nflagged += score_batch(model, batch, size, writer,
+                                            args.threshold, cropdir, 
+                                            args.positive)
+                    ntiles += len(batch)
+                    batch = []
+            del rgb
+        if batch:
+            nflagged += score_batch(model, batch, size, writer,
+                                    args.threshold, cropdir, args.positive)
+            ntiles += len(batch)
+
+    print('%d tiles scored, %d flagged. Scores written to %s'
+          % (ntiles, nflagged, output))
+
+if __name__ == '__main__':
+    main()
@@ -1,83 +1,163 @@
 #!/usr/bin/env python3
 """
-From list of input images, output two csv files (train.csv/test.csv) that
-contain the the group and path of each images. For each group, randomly split
-the files between train/test 80:20. 
+From list of input images (or dirs to index), output two csv files
+(train.csv/test.csv) that contain the the group and path of each images. For
+each group, randomly split the files between train/test (80:20 by default). 
 
 Group id is taken from the parent directory of the image file, ex:
     some/path/Group A/im.png  # Group A
     other/path/Group A/im.png # Group A
     some/path/Group B/im.png  # Group B
+
+Files are bucketed by group in a single pass and rows are written straight to
+csv, so millions of paths can be split without building a DataFrame. Integer
+codes are assigned once from the sorted set of all groups, so they agree
+between train, test and every fold.
+
+With `-k/--kfold K` the files of each group are dealt round robin into K
+folds, and K pairs of train-<i>.csv/test-<i>.csv are written, where fold i is
+the test set and the remaining folds are the training set.
 """
 
 import os
-from glob import glob
+import csv
 import argparse
-import pandas as pd
 import numpy as np
+import file_index
 
 def parse_args():
     ap = argparse.ArgumentParser()
     ap.add_argument('infiles', nargs='+', 
-                    help='Image files, structured as <group>/image.ext')
+                    help='Image files, structured as <group>/image.ext, or \
+                    dirs to search for them')
     ap.add_argument('-d', '--dir', type=str, default='',
                     help='Output dir. Default names will be [train/test].csv')
+    ap.add_argument('-p', '--porportion', type=float, default=0.8,
+                    help='Porportion of each group to put in the training \
+                    set (def: 0.8). Ignored when --kfold is given')
+    ap.add_argument('-k', '--kfold', type=int, default=0,
+                    help='Write K (>= 2) train/test folds instead of one \
+                    split')
+    ap.add_argument('-s', '--seed', type=int, default=None,
+                    help='Random seed, for a reproducible split')
+    ap.add_argument('-m', '--manifest', type=str,
+                    help='File manifest to cache dir indexing in')
     args = ap.parse_args()
+    if args.kfold == 1 or args.kfold < 0:
+        ap.error('--kfold must be at least 2')
+    if not 0 < args.porportion < 1:
+        ap.error('--porportion must be a fraction between 0 and 1')
     return args
 
-def assign_integer_encoding(df, label_colname, integer_colname = 'integer_code'):
+def expand_infiles(infiles, manifest=None):
+    """
+    Replace any dirs in infiles with the image files found below them
+    """
+    files = [f for f in infiles if not os.path.isdir(f)]
+    dirs = [d for d in infiles if os.path.isdir(d)]
+    if dirs:
+        files.extend(f[0] for f in file_index.index_files(dirs, 
+                                                         manifest=manifest))
+    return files
+
+def group_files(infiles):
+    """
+    Bucket files by group (name of the parent dir) in one pass.
+
+    Ret groups : dict of group : list of absolute paths
+    """
+    groups = {}
+    for f in infiles:
+        f = os.path.abspath(f)
+        g = os.path.basename(os.path.dirname(f))
+        groups.setdefault(g, []).append(f)
+    return groups
+
+def integer_encoding(labels):
     """
-    Add a column of labels encoded as integers
+    Map each label to an integer code. Labels are sorted first, so codes match
+    those given by sklearn's LabelEncoder.
     """
-    import sklearn.preprocessing
-    df2 = df.copy()
-    labels = df2[label_colname]
-
-    label_encoder = sklearn.preprocessing.LabelEncoder()
-    integer_encoded = label_encoder.fit_transform(np.array(labels))
-
-    df2[integer_colname] = integer_encoded
-    return df2
-
-def main(infiles, outdir='', columns=['label', 'file_abspath']):
-    absfiles = [os.path.abspath(f) for f in infiles]
-    tupes = [(f.split('/')[-2], f) for f in absfiles]
-    df = pd.DataFrame(tupes, columns=columns)
-
-    def split_df_rand(df, porportion=0.8):
-        """
-        Ret ab : tuple of the split df a is of size porportion, b of
-            1-porportion
-        """
-        msk = np.random.rand(len(df)) < 0.8
-        a = df[msk]
-        b = df[~msk]
-        return (a, b)
-    
-    # Split df into two random samples (80/20) with porportional groups for
-    # training/testing
-    groups = np.unique(df[columns[0]])
-    dfdict = {'train' : [], 'test' : []}
-    for g in groups:
-        gf = df[df[columns[0]] == g]
-        gfs = split_df_rand(gf, 0.8)
-        dfdict['train'].append(gfs[0])
-        dfdict['test'].append(gfs[1])
-    train = pd.concat(dfdict['train'])
-    test = pd.concat(dfdict['test'])
+    return dict((l, i) for i, l in enumerate(sorted(set(labels))))
+
+def split_group(files, porportion, rng):
+    """
+    Ret ab : tuple of lists, a holds round(porportion * len(files)) randomly
+        chosen files and b the rest
+    """
+    idx = rng.permutation(len(files))
+    n = int(round(porportion * len(files)))
+    a = [files[i] for i in idx[:n]]
+    b = [files[i] for i in idx[n:]]
+    return (a, b)
+
+def fold_group(files, k, rng):
+    """
+    Ret folds : list of k lists, files shuffled and dealt round robin so fold
+        sizes differ by at most one
+    """
+    idx = rng.permutation(len(files))
+    return [[files[i] for i in idx[j::k]] for j in range(k)]
+
+def write_rows(writer, label, files, code):
+    writer.writerows((label, f, code) for f in files)
+
+def main(infiles, outdir='', porportion=0.8, kfold=0, seed=None, 
+         manifest=None, columns=['label', 'file_abspath', 'integer_code']):
+    if kfold == 1 or kfold < 0:
+        raise ValueError("kfold must be 0 (no folds) or at least 2, got %d" 
+                         % kfold)
+    if not 0 < porportion < 1:
+        raise ValueError("porportion must be between 0 and 1, got %g" 
+                         % porportion)
+    rng = np.random.RandomState(seed)
+    groups = group_files(expand_infiles(infiles, manifest))
 
     # assign integer encoding for simpler one-hot encoding downstream
-    train = assign_integer_encoding(train, 'label')
-    test = assign_integer_encoding(test, 'label')
+    codes = integer_encoding(groups.keys())
+
+    if kfold > 1:
+        small = sorted(g for g in codes if len(groups[g]) < kfold)
+        if small:
+            print('Warning: fewer than %d files in group(s) %s, some test '
+                  'folds will have no files from them' 
+                  % (kfold, ', '.join(small)))
+        # Deal each group into k folds, fold i is the test set of split i
+        folds = dict((g, fold_group(groups[g], kfold, rng)) for g in codes)
+        names = [('train-%d.csv' % i, 'test-%d.csv' % i) 
+                 for i in range(kfold)]
+    else:
+        # Split each group into two random samples with porportional groups
+        # for training/testing
+        folds = dict((g, split_group(groups[g], porportion, rng)) 
+                     for g in codes)
+        names = [('train.csv', 'test.csv')]
 
-    train.to_csv(os.path.join(outdir, 'train.csv'), index=False)
-    test.to_csv(os.path.join(outdir, 'test.csv'), index=False)
+    for i, (trainname, testname) in enumerate(names):
+        counts = {'train' : 0, 'test' : 0}
+        with open(os.path.join(outdir, trainname), 'w', newline='') as ftrain, \
+             open(os.path.join(outdir, testname), 'w', newline='') as ftest:
+            train = csv.writer(ftrain)
+            test = csv.writer(ftest)
+            train.writerow(columns)
+            test.writerow(columns)
+            for g, code in codes.items():
+                if kfold > 1:
+                    test_files = folds[g][i]
+                    train_files = [f for j, fold in enumerate(folds[g]) 
+                                   if j != i for f in fold]
+                else:
+                    train_files, test_files = folds[g]
+                write_rows(train, g, train_files, code)
+                write_rows(test, g, test_files, code)
+                counts['train'] += len(train_files)
+                counts['test'] += len(test_files)
 
-    print('training set: %d files across %d labels' 
-          %(len(train), len(np.unique(train[columns[0]]))))
-    print('test set: %d files across %d labels' 
-          %(len(test), len(np.unique(test[columns[0]]))))
+        print('%s: %d files, %s: %d files, across %d labels' 
+              %(trainname, counts['train'], testname, counts['test'], 
+                len(codes)))
 
 if __name__ == '__main__':
     args = parse_args()
-    main(args.infiles, args.dir)
+    main(args.infiles, args.dir, args.porportion, args.kfold, args.seed,
+         args.manifest)
@@ -167,50 +167,57 @@ def path_dialog(whatyouwant):
         sys.exit(m)
 
     return path
+def format_trailing_nums(s):
+    """ 
+    ensure trailing digits are separated from channel_name w/ '-', and the
+    numeric prefix is followed by one
+    """
+    import re
+
+    # trim .extension
+    sp = '.'.join(s.split('.')[:-1])
+
+    # match digits at end of string
+    m = re.search('\d+$', sp)
+    if not m:
+        # string does not end in num
+        new = s
+    else:
+        # string ends in num
+        endnum = m.group()
+        new = endnum.join(sp.split(endnum)[:-1])
+        if new[-1] == '-':
+            # Trailing '-', rm to avoid getting '01-blue--2.tif'
+            new = new[:-1]
+        ext = '.' + s.split('.')[-1]
+        new = '-'.join((new, endnum)) + ext
+
+    # correct no seperator following prefix digits
+    # if I was good at regex this would take like zero lines
+    pfx = new.split('-')[0]
+    if not pfx.isdigit():
+        m = re.search('^\d+', pfx)
+        if m:
+            mid = pfx.replace(m.group(), '')
+            end = '-'.join(new.split('-')[1:])
+            new = '-'.join((m.group(), mid, end))
+
+    return new
+def format_filenames(filenames):
+    """ 
+    Ret the cleaned up names for filenames, without renaming anything
+    """
+    # replace whitespace
+    filenames = ['-'.join(f.split()) for f in filenames]
+
+    # ensure trailing digits are separated from channel_name w/ '-'
+    filenames = [format_trailing_nums(f) for f in filenames]
+    return filenames
 def cleanup_filenames(filenames):
     """ 
     replace whitespace and exclude bright field tiff files
     """
     def rename(filenames):
-        def format_filenames(filenames):
-            def format_trailing_nums(s):
-                import re
-
-                # trim .extension
-                sp = '.'.join(s.split('.')[:-1])
-
-                # match digits at end of string
-                m = re.search('\d+$', sp)
-                if not m:
-                    # string does not end in num
-                    new = s
-                else:
-                    # string ends in num
-                    endnum = m.group()
-                    new = endnum.join(sp.split(endnum)[:-1])
-                    if new[-1] == '-':
-                        # Trailing '-', rm to avoid getting '01-blue--2.tif'
-                        new = new[:-1]
-                    ext = '.' + s.split('.')[-1]
-                    new = '-'.join((new, endnum)) + ext
-
-                # correct no seperator following prefix digits
-                # if I was good at regex this would take like zero lines
-                pfx = new.split('-')[0]
-                if not pfx.isdigit():
-                    m = re.search('^\d+', pfx)
-                    if m:
-                        mid = pfx.replace(m.group(), '')
-                        end = '-'.join(new.split('-')[1:])
-                        new = '-'.join((m.group(), mid, end))
-
-                return new
-            # replace whitespace
-            filenames = ['-'.join(f.split()) for f in filenames]
-
-            # ensure trailing digits are separated from channel_name w/ '-'
-            filenames = [format_trailing_nums(f) for f in filenames]
-            return filenames
         for old, new in zip(filenames, format_filenames(filenames)):
             os.rename(old, new)
     rename(filenames)
@@ -274,11 +281,11 @@ def channel_combos(files):
     for f in files:
         # get the first letter of word following the img num prefix ('\d*-')
         c = f.split('-')[1].lower()[0]
-        if c is 'r':
+        if c == 'r':
             colors['r'].append(f)
-        elif c is 'g':
+        elif c == 'g':
             colors['g'].append(f)
-        elif c is 'b':
+        elif c == 'b':
             colors['b'].append(f)
 
     # choose one item from each list, making all possible combos
@@ -307,78 +314,92 @@ def tiffs_iterate_combos(d):
         list is all tuples for a given image number.
     """
     imgs = {}
-    for k, v in d.iteritems():
+    for k, v in d.items():
         imgs[k] = channel_combos(v)
     
     # dict of list of tuples
     return imgs
 
 ## Resturaunt Nouveau System
-def preproc_imgs(imgs, sigma, oudtdir='preproc'):
+def get_uids(imgs):
     """ 
-    Hastily commented preprocessing. 'uids' is a dumb name for this dict.
+    Get a unique id for each distinct len3 list of r,g,b files. 'uids' is a
+    dumb name for this dict.
 
     imgs : dict w/ image numbers as keys 
     """
-    def get_uids(imgs):
-        # Get a unique id for each distinct len3 list of r,g,b files
-        uids = {}
-        for k, imls in imgs.iteritems():
-            if len(imls) == 1:
-                if type(imls[0]) is list:
-                    # then we have a len1 list containing another list for some reason
-                    # flatten it
-                    uids[k] = imls[0]
-                else:
-                    uids[k] = imls
-
-            if len(imls) > 1:
-                # we have multiple rgb combos, append nums >1 to num/uid
+    uids = {}
+    for k, imls in imgs.items():
+        if len(imls) == 1:
+            if type(imls[0]) is list:
+                # then we have a len1 list containing another list for some reason
+                # flatten it
                 uids[k] = imls[0]
-                for i in range(1,len(imls)):
-                    uid = '-'.join((k, str(i+1)))
-                    uids[uid] = imls[i]
-        return uids
-    def illum_correction(x, sigma, method='subtract'):
-        """ 
-        Gaussian blurr background subtraction.
-
-        Aim is to smooth image until it is devoid of features, but retains the
-        weighted average intensity across the image that corresponds to the
-        underlying illumination pattern. Then subtract
-
-        This correction is only aware of the single image/channel that it is fed.
-        It might be a better idea to try and implement illumination correction
-        using multiple channels/images taken from the same experiment.
-        """
-        y = ndi.gaussian_filter(x, sigma=sigma, mode='constant', cval=0)
-        if method == 'subtract':
-            return cv2.subtract(x, y)
-        elif method == 'divide':
-            return cv2.divide(x, y)
-        else:
-            raise ValueError("Unsupported method: %s" %method)
+            else:
+                uids[k] = imls
+
+        if len(imls) > 1:
+            # we have multiple rgb combos, append nums >1 to num/uid
+            uids[k] = imls[0]
+            for i in range(1,len(imls)):
+                uid = '-'.join((k, str(i+1)))
+                uids[uid] = imls[i]
+    return uids
+def illum_correction(x, sigma, method='subtract'):
+    """ 
+    Gaussian blurr background subtraction.
+
+    Aim is to smooth image until it is devoid of features, but retains the
+    weighted average intensity across the image that corresponds to the
+    underlying illumination pattern. Then subtract
 
+    This correction is only aware of the single image/channel that it is fed.
+    It might be a better idea to try and implement illumination correction
+    using multiple channels/images taken from the same experiment.
+    """
+    y = ndi.gaussian_filter(x, sigma=sigma, mode='constant', cval=0)
+    if method == 'subtract':
+        return cv2.subtract(x, y)
+    elif method == 'divide':
+        return cv2.divide(x, y)
+    else:
+        raise ValueError("Unsupported method: %s" %method)
+def merge_channels(uid, imls, sigma):
+    """ 
+    Read each of one set of 3 channel filenames, preform illumination
+    correction, and stack them together into an rgb image.
+
+    Ret rgb : 3d ndarray, or None if the channels could not be stacked
+    """
+    # List of greyscale channel ims : r,g,b
+    ims = [tiffread(f) for f in imls] 
+
+    # Guassian blur bg subtraction for each channel
+    ims_corr = [illum_correction(x, sigma) for x in ims]
+
+    try:
+        return np.dstack(ims_corr)
+    except ValueError as e:
+        print('Skipping image # %s. Channels have non uniform shape? %s' 
+              % (uid, e))
+        print('R: %s' % str(ims_corr[0].shape))
+        print('G: %s' % str(ims_corr[1].shape))
+        print('B: %s' % str(ims_corr[2].shape))
+        return None
+def preproc_imgs(imgs, sigma, oudtdir='preproc'):
+    """ 
+    Hastily commented preprocessing. 
+
+    imgs : dict w/ image numbers as keys 
+    """
     uids = get_uids(imgs)
     # For each set of 3 channel filenames, read each image, preform
     # illumination correction, and stack them together into an rgb image.
     rgb = {}
-    for uid, imls in uids.iteritems():
-
-        # List of greyscale channel ims : r,g,b
-        ims = [tiffread(f) for f in imls] 
-
-        # Guassian blur bg subtraction for each channel
-        ims_corr = [illum_correction(x, sigma) for x in ims]
-
-        try:
-            rgb[uid] = np.dstack(ims_corr)
-        except ValueError as e:
-            print('Skipping image # %s. Channels have non uniform shape? %s' 
-                  % (uid, e))
-            print('R: %s' % str(ims_corr[0].shape))
-            print('G: %s' % str(ims_corr[1].shape))
-            print('B: %s' % str(ims_corr[2].shape))
+    for uid, imls in uids.items():
+        im = merge_channels(uid, imls, sigma)
+        if im is not None:
+            rgb[uid] = im
     
     return rgb
 def outfile_names(rgb, suffix='rgb', ext='.tif'):